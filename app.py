@@ -23,34 +23,189 @@ Flask Basics Explained:
 - jsonify() - Converts Python data to JSON (for JavaScript to use)
 """
 
-from flask import Flask, render_template, request, redirect, url_for, jsonify
-from datetime import datetime, date, timedelta
+from flask import (
+    Flask, Response, render_template, stream_template, request, redirect,
+    url_for, jsonify, make_response, g
+)
+from flask.helpers import get_debug_flag
+from flask.json.provider import DefaultJSONProvider
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+import threading
+import time
+import jinja2
 import database
 
+# orjson is an optional speed-up for JSON responses; the app works without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# waitress is an optional production server (used when running app.py);
+# without it the app falls back to Flask's built-in development server
+try:
+    from waitress import serve
+except ImportError:
+    serve = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider that encodes with orjson instead of the standard
+    json module. Used by jsonify() and the |tojson template filter.
+    """
+
+    def _options(self, sort_keys=None, indent=None):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys if sort_keys is None else sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        option = self._options(kwargs.get('sort_keys'), kwargs.get('indent'))
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        option = self._options(indent=self._app.debug)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=option),
+            mimetype=self.mimetype
+        )
+
+
 # Create the Flask application
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+# Templates don't change while the app is running, so Jinja doesn't need to
+# check them for edits on every render (debug mode turns this back on).
+# Compiled templates are also cached on disk, next to the database, so a
+# fresh start doesn't have to recompile them from source.
+app.jinja_env.auto_reload = False
+_jinja_cache_dir = Path(database.DATABASE_PATH).parent / '.jinja_cache'
+_jinja_cache_dir.mkdir(parents=True, exist_ok=True)
+app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(directory=str(_jinja_cache_dir))
 
 # Initialize the database when the app starts
 database.init_database()
 
 
+@app.before_request
+def load_current_time():
+    """
+    Read the clock once per request so every route (and every place in a
+    route) sees the same "today" and "now".
+    """
+    now = datetime.now()
+    g.today = now.date()
+    g.today_iso = g.today.isoformat()
+    g.now_hm = now.strftime('%H:%M')
+
+
+@app.teardown_appcontext
+def rollback_on_error(exception):
+    """
+    Database connections are kept open between requests (one per thread),
+    so make sure a request that failed mid-save doesn't leave a
+    transaction hanging on the connection.
+    """
+    if exception is not None:
+        database.rollback()
+
+
+# ----- Response Cache -----
+# Pages that only show data are cached until something is saved or deleted
+# (tracked by database.get_data_version()), or until `ttl` seconds pass so
+# pages that depend on today's date still roll over.
+
+RESPONSE_CACHE_MAX_ENTRIES = 256
+
+_response_cache = {}  # (path, args) -> (data_version, expires_at, body, mimetype)
+
+
+def cached_response(ttl=30, vary=()):
+    """
+    Decorator that caches a GET view's rendered output.
+    Only the query arguments listed in `vary` are part of the cache key.
+    Caching is skipped in debug mode so template edits show up right away.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if app.debug:
+                return view(*args, **kwargs)
+            
+            key = (request.path, tuple((name, request.args.get(name)) for name in vary))
+            version = database.get_data_version()
+            now = time.monotonic()
+            
+            hit = _response_cache.get(key)
+            if hit is not None and hit[0] == version and hit[1] > now:
+                return app.response_class(hit[2], mimetype=hit[3])
+            
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                if len(_response_cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+                    _response_cache.clear()
+                _response_cache[key] = (version, now + ttl, response.get_data(), response.mimetype)
+            return response
+        return wrapper
+    return decorator
+
+
+# ----- ETags for API Routes -----
+# The version counters restart at 0 with the app, so the ETag also includes
+# the start time; otherwise a tag from before a restart could match again.
+
+_STARTED_AT = int(time.time())
+
+
+def versioned_etag(tag, max_age=5):
+    """
+    Decorator that tags a JSON response with the current data version for
+    `tag` and answers 304 Not Modified when the browser already has it.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = f'{tag}-{_STARTED_AT}-{database.get_data_version(tag)}'
+            
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.max_age = max_age
+            return response
+        return wrapper
+    return decorator
+
+
 # ----- Page Routes -----
 
 @app.route('/')
+@cached_response(ttl=30)
 def home():
     """
     Home page / Dashboard
     Shows a summary of recent sleep data and quick actions.
     """
-    # Get recent entries for the dashboard
-    recent_entries = database.get_all_sleep_entries(limit=7)
-    today = date.today().isoformat()
-    today_entry = database.get_sleep_entry(today)
+    # Get recent entries and today's entry for the dashboard
+    today = g.today_iso
+    bundle = database.get_home_bundle(today, limit=7)
     
     return render_template(
         'index.html',
-        recent_entries=recent_entries,
-        today_entry=today_entry,
+        recent_entries=bundle['recent'],
+        today_entry=bundle['today'],
         today=today
     )
 
@@ -63,7 +218,7 @@ def log_entry():
     POST: Save the submitted form data
     """
     # Default to today's date, but allow editing other dates
-    entry_date = request.args.get('date', date.today().isoformat())
+    entry_date = request.args.get('date', g.today_iso)
     
     if request.method == 'POST':
         # Collect form data
@@ -71,10 +226,6 @@ def log_entry():
             'entry_date': request.form.get('entry_date'),
             'bed_time': request.form.get('bed_time'),
             'wake_time': request.form.get('wake_time'),
-            'med_melatonin': 1 if request.form.get('med_melatonin') else 0,
-            'med_weed': 1 if request.form.get('med_weed') else 0,
-            'med_cold_medicine': 1 if request.form.get('med_cold_medicine') else 0,
-            'med_benadryl': 1 if request.form.get('med_benadryl') else 0,
             'wake_feeling': request.form.get('wake_feeling'),
             'overall_mood': request.form.get('overall_mood'),
             'wake_feeling_notes': request.form.get('wake_feeling_notes'),
@@ -82,6 +233,9 @@ def log_entry():
             'general_notes': request.form.get('general_notes'),
         }
         
+        # Sleep aid checkboxes are only sent by the browser when checked
+        data.update({name: 1 if request.form.get(name) else 0 for name in database.MED_COLUMNS})
+        
         database.save_sleep_entry(data)
         return redirect(url_for('home'))
     
@@ -99,19 +253,32 @@ def log_entry():
 def history():
     """
     View all past sleep entries in a table format.
+    The page is streamed as it renders, so a long history doesn't have to
+    be loaded (or rendered) all at once before the browser sees anything.
     """
-    entries = database.get_all_sleep_entries()
-    return render_template('history.html', entries=entries)
+    summary = database.get_history_summary()
+    entries = database.iter_all_sleep_entries()
+    return Response(
+        stream_template('history.html', entries=entries, summary=summary),
+        mimetype='text/html'
+    )
+
+
+MONTH_NAMES = (
+    'January', 'February', 'March', 'April', 'May', 'June',
+    'July', 'August', 'September', 'October', 'November', 'December'
+)
 
 
 @app.route('/calendar')
+@cached_response(ttl=30, vary=('year', 'month'))
 def calendar_view():
     """
     Calendar view showing mood/sleep data for each day.
     """
     # Get month/year from URL or default to current
-    year = request.args.get('year', date.today().year, type=int)
-    month = request.args.get('month', date.today().month, type=int)
+    year = request.args.get('year', g.today.year, type=int)
+    month = request.args.get('month', g.today.month, type=int)
     
     # Handle month navigation
     if month < 1:
@@ -130,6 +297,7 @@ def calendar_view():
         'calendar.html',
         year=year,
         month=month,
+        month_name=MONTH_NAMES[month - 1],
         entries_by_date=entries_by_date
     )
 
@@ -141,8 +309,8 @@ def mood_checkin():
     """
     if request.method == 'POST':
         data = {
-            'entry_date': request.form.get('entry_date', date.today().isoformat()),
-            'check_time': request.form.get('check_time', datetime.now().strftime('%H:%M')),
+            'entry_date': request.form.get('entry_date', g.today_iso),
+            'check_time': request.form.get('check_time', g.now_hm),
             'mood_level': request.form.get('mood_level'),
             'energy_level': request.form.get('energy_level'),
             'notes': request.form.get('notes'),
@@ -151,8 +319,8 @@ def mood_checkin():
         database.save_mood_checkin(data)
         return redirect(url_for('home'))
     
-    today = date.today().isoformat()
-    current_time = datetime.now().strftime('%H:%M')
+    today = g.today_iso
+    current_time = g.now_hm
     todays_checkins = database.get_mood_checkins(today)
     
     return render_template(
@@ -164,26 +332,28 @@ def mood_checkin():
 
 
 @app.route('/charts')
+@cached_response(ttl=30)
 def charts():
     """
     View charts and analytics of sleep data.
     """
-    entries = database.get_all_sleep_entries(limit=30)
-    checkins = database.get_recent_mood_checkins(days=30)
+    entries, checkin_hours = database.get_charts_bundle(limit=30, days=30)
     
     return render_template(
         'charts.html',
         entries=entries,
-        checkins=checkins
+        checkin_hours=checkin_hours
     )
 
 
 # ----- API Routes (for JavaScript to fetch data) -----
 
 @app.route('/api/entries')
+@versioned_etag('sleep_entries')
+@cached_response(ttl=30)
 def api_entries():
-    """Return all entries as JSON for charts."""
-    entries = database.get_all_sleep_entries(limit=30)
+    """Return the last 30 entries as JSON for charts."""
+    entries = database.get_chart_sleep_series(limit=30)
     return jsonify(entries)
 
 
@@ -202,6 +372,7 @@ def shutdown():
 
 
 @app.route('/api/checkins/<entry_date>')
+@versioned_etag('mood_checkins')
 def api_checkins(entry_date):
     """Return mood check-ins for a specific date."""
     checkins = database.get_mood_checkins(entry_date)
@@ -215,6 +386,33 @@ def api_delete_checkin(checkin_id):
     return jsonify({'success': True})
 
 
+# ----- Background Maintenance -----
+
+def schedule_maintenance(delay=0):
+    """
+    Run database maintenance (VACUUM + ANALYZE) in the background after
+    `delay` seconds, then again every database.MAINTENANCE_INTERVAL.
+    """
+    def run():
+        delay = database.MAINTENANCE_INTERVAL
+        try:
+            database.run_maintenance()
+        except Exception:
+            # Try again once this run's claim has expired
+            delay = database.MAINTENANCE_CLAIM_TIMEOUT
+            raise
+        finally:
+            # Reschedule before closing, so an error while closing can't
+            # stop maintenance for good
+            schedule_maintenance(delay)
+            # Timer threads don't get reused, so don't leave a connection open
+            database.close_connection()
+    
+    timer = threading.Timer(delay, run)
+    timer.daemon = True  # don't keep the app alive just for this
+    timer.start()
+
+
 # ----- Run the Application -----
 
 if __name__ == '__main__':
@@ -223,6 +421,14 @@ if __name__ == '__main__':
     print("  Open your browser to: http://localhost:5000")
     print("=" * 50 + "\n")
     
-    # debug=True enables auto-reload when you change code
-    # Use debug=False in production
-    app.run(debug=True, port=5000)
+    # Runs right away if it's never been done (or not in the last day)
+    schedule_maintenance()
+    
+    # Debug mode (auto-reload when you change code) is off by default;
+    # set FLASK_DEBUG=1 to turn it on while developing
+    if serve is None or get_debug_flag():
+        app.run(port=5000, threaded=True)
+    else:
+        # waitress handles requests on a pool of threads; each thread keeps
+        # its own database connection (see database.get_connection)
+        serve(app, host='127.0.0.1', port=5000, threads=8)
@@ -5,6 +5,11 @@ Uses SQLite for simple, portable local storage.
 
 import sqlite3
 import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 from datetime import datetime, date
 from pathlib import Path
 
@@ -16,14 +21,127 @@ if os.environ.get('SLEEP_TRACKER_DB'):
 else:
     DATABASE_PATH = Path(__file__).parent / "sleep_tracker.db"
 
+# Sleep aid columns in sleep_entries, each stored as 0 or 1.
+# Packing them into one bitmask column would save a couple of bytes per row,
+# but would need a migration of existing rows and unpacking in every
+# template and chart script that reads them.
+MED_COLUMNS = ('med_melatonin', 'med_weed', 'med_cold_medicine', 'med_benadryl')
+
+# Values used for any sleep entry field the caller leaves out
+# (entry_date is required and has no default)
+SLEEP_ENTRY_DEFAULTS = {
+    'bed_time': None,
+    'wake_time': None,
+    **{name: 0 for name in MED_COLUMNS},
+    'wake_feeling': None,
+    'overall_mood': None,
+    'wake_feeling_notes': None,
+    'mood_notes': None,
+    'general_notes': None,
+}
+
+# One connection per thread: sqlite3 connections shouldn't be shared
+# between threads, but reusing one per thread keeps its page cache warm
+# and its prepared statements cached between requests
+_local = threading.local()
+
 
 def get_connection():
-    """Create a connection to the SQLite database."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row  # Allows accessing columns by name
+    """Get this thread's connection to the SQLite database, opening it if needed."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        return conn
+    
+    # isolation_level=None puts sqlite3 in autocommit mode; multi-statement
+    # work opens its own transaction with transaction() below
+    conn = sqlite3.connect(
+        DATABASE_PATH,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=256
+    )
+    # No row_factory: writes never read rows back, and the read functions
+    # turn rows into dicts themselves with _rows_to_dicts()
+    
+    # Per-connection tuning (journal_mode=WAL is persistent, see init_database)
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA mmap_size = 268435456")  # 256 MB
+    conn.execute("PRAGMA cache_size = -65536")    # 64 MB
+    conn.execute("PRAGMA cache_spill = OFF")      # keep dirty pages in memory until commit
+    
+    _local.conn = conn
     return conn
 
 
+def _rows_to_dicts(cursor):
+    """
+    Fetch all remaining rows from an executed cursor as a list of dicts.
+    Builds the column names once and zips them with each row tuple.
+    """
+    keys = [column[0] for column in cursor.description]
+    return [dict(zip(keys, row)) for row in cursor.fetchall()]
+
+
+def rollback():
+    """Roll back any transaction left open on this thread's connection."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+def close_connection():
+    """Let SQLite refresh its query planner stats, then close this thread's connection."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    try:
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
+        _local.conn = None
+
+
+@contextmanager
+def transaction(*tags, immediate=False):
+    """
+    Run the statements in the `with` block as one transaction on this
+    thread's connection: COMMIT on success, ROLLBACK on error.
+    
+    `tags` are the query cache tags the block writes to; they're
+    invalidated once the block commits (or rolls back). If a transaction is already
+    open, the block joins it and its tags are invalidated when that outer
+    transaction commits, so several saves can be batched into one commit:
+    
+        with database.transaction():
+            database.save_sleep_entry(entry)
+            database.save_mood_checkin(checkin)
+    """
+    conn = get_connection()
+    
+    if conn.in_transaction:
+        _local.pending_tags.update(tags)
+        yield conn
+        return
+    
+    _local.pending_tags = set(tags)
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        # SQLite may already have rolled back by itself (disk full, I/O
+        # error), and a second ROLLBACK would hide the original error
+        if conn.in_transaction:
+            conn.rollback()
+        for tag in _local.pending_tags:
+            _invalidate(tag)
+        raise
+    conn.execute("COMMIT")
+    
+    for tag in _local.pending_tags:
+        _invalidate(tag)
+
+
 def init_database():
     """
     Create all necessary tables if they don't exist.
@@ -32,6 +150,17 @@ def init_database():
     conn = get_connection()
     cursor = conn.cursor()
     
+    # A brand-new (empty) database gets larger pages, so date-ordered scans
+    # touch fewer of them. page_size only applies before anything is written
+    # (and before switching to WAL), so existing databases keep theirs.
+    if cursor.execute("PRAGMA page_count").fetchone()[0] == 0:
+        cursor.execute("PRAGMA page_size = 8192")
+    
+    # Write-ahead logging lets the read pages keep working while a save
+    # is in progress. The setting is stored in the database file, so it
+    # only needs to be set once here rather than on every connection.
+    cursor.execute("PRAGMA journal_mode = WAL")
+    
     # Main sleep entries table
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS sleep_entries (
@@ -76,8 +205,156 @@ def init_database():
         )
     """)
     
+    # Small key/value table for app bookkeeping (e.g. last maintenance run)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    
+    # Check-ins are always looked up by date and listed by time.
+    # (sleep_entries.entry_date already has an index from its UNIQUE
+    # constraint, which SQLite can also walk backwards for ORDER BY DESC.)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_checkins_date_time
+        ON mood_checkins(entry_date, check_time)
+    """)
+    
+    # Gather planner statistics the first time the database is set up;
+    # after that, PRAGMA optimize in close_connection() below refreshes
+    # them each time the app starts
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+    )
+    if cursor.fetchone() is None:
+        cursor.execute("ANALYZE")
+    
     conn.commit()
-    conn.close()
+    close_connection()
+
+
+# ----- Maintenance -----
+
+MAINTENANCE_INTERVAL = 24 * 60 * 60  # seconds between VACUUM/ANALYZE runs
+MAINTENANCE_CLAIM_TIMEOUT = 60 * 60  # seconds before a failed run can be retried
+
+
+def _set_meta(conn, key, value):
+    """Insert or replace a value in the meta table."""
+    conn.execute("""
+        INSERT INTO meta (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    """, (key, value))
+
+
+def run_maintenance():
+    """
+    Defragment the database file and refresh query planner statistics,
+    unless that was already done within the last MAINTENANCE_INTERVAL.
+    The last run time is stored in the database, so if several processes
+    share the file only one of them does the work.
+    Returns True if maintenance ran.
+    """
+    now = time.time()
+    
+    # Claim this run inside a write transaction so two processes can't
+    # both decide maintenance is due. The claim expires after
+    # MAINTENANCE_CLAIM_TIMEOUT, so a run that failed gets retried.
+    with transaction(immediate=True) as conn:
+        meta = dict(conn.execute(
+            "SELECT key, value FROM meta"
+            " WHERE key IN ('last_maintenance', 'maintenance_claimed')"
+        ).fetchall())
+        if now - float(meta.get('last_maintenance', 0)) < MAINTENANCE_INTERVAL:
+            return False
+        if now - float(meta.get('maintenance_claimed', 0)) < MAINTENANCE_CLAIM_TIMEOUT:
+            return False
+        _set_meta(conn, 'maintenance_claimed', str(now))
+    
+    # VACUUM can't run inside a transaction, so the run is only recorded
+    # as done once it has finished
+    conn.execute("PRAGMA optimize")
+    conn.execute("VACUUM")
+    conn.execute("ANALYZE")
+    
+    with transaction() as conn:
+        _set_meta(conn, 'last_maintenance', str(now))
+    return True
+
+
+# ----- Query Cache -----
+# Read queries are cached for a short time, keyed by function + arguments.
+# Every write function invalidates the tag for the table it changed, so
+# the TTL only matters for queries that depend on the current date.
+
+CACHE_MAX_ENTRIES = 256
+
+_query_cache = OrderedDict()  # (tag, name, args, kwargs) -> (expires_at, result)
+_cache_generation = {}        # tag -> number of times it has been invalidated
+_data_version = 0             # bumped on every write, for caches outside this module
+_cache_lock = threading.Lock()
+
+
+def cached(ttl=30, tag=None):
+    """
+    Decorator that caches a read function's result for `ttl` seconds.
+    `tag` may be a tuple when the result depends on more than one table.
+    Cached results are shared between callers, so treat them as read-only.
+    Inside an open transaction the cache is bypassed, so rows that might
+    still be rolled back are never served to (or stored for) anyone else.
+    """
+    tags = tag if isinstance(tag, tuple) else (tag,)
+    
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if get_connection().in_transaction:
+                return func(*args, **kwargs)
+            
+            key = (tags, func.__name__, args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            
+            with _cache_lock:
+                hit = _query_cache.get(key)
+                if hit is not None and hit[0] > now:
+                    _query_cache.move_to_end(key)
+                    return hit[1]
+                generation = [_cache_generation.get(t, 0) for t in tags]
+            
+            result = func(*args, **kwargs)
+            
+            with _cache_lock:
+                # Don't store a result if a write invalidated the tag meanwhile
+                if [_cache_generation.get(t, 0) for t in tags] != generation:
+                    return result
+                _query_cache[key] = (now + ttl, result)
+                _query_cache.move_to_end(key)
+                while len(_query_cache) > CACHE_MAX_ENTRIES:
+                    _query_cache.popitem(last=False)
+            return result
+        return wrapper
+    return decorator
+
+
+def get_data_version(tag=None):
+    """
+    Return a counter that changes whenever any data is written,
+    or only when data for the given tag ("sleep_entries", "mood_checkins") is.
+    """
+    if tag is None:
+        return _data_version
+    return _cache_generation.get(tag, 0)
+
+
+def _invalidate(tag):
+    """Drop every cached result for the given tag."""
+    global _data_version
+    with _cache_lock:
+        _data_version += 1
+        _cache_generation[tag] = _cache_generation.get(tag, 0) + 1
+        for key in [k for k in _query_cache if tag in k[0]]:
+            del _query_cache[key]
 
 
 # ----- Sleep Entry Functions -----
@@ -87,75 +364,37 @@ def save_sleep_entry(data):
     Save or update a sleep entry for a specific date.
     If an entry already exists for that date, it updates it.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Check if entry exists for this date
-    cursor.execute(
-        "SELECT id FROM sleep_entries WHERE entry_date = ?", 
-        (data['entry_date'],)
-    )
-    existing = cursor.fetchone()
-    
-    if existing:
-        # Update existing entry
-        cursor.execute("""
-            UPDATE sleep_entries SET
-                bed_time = ?,
-                wake_time = ?,
-                med_melatonin = ?,
-                med_weed = ?,
-                med_cold_medicine = ?,
-                med_benadryl = ?,
-                wake_feeling = ?,
-                overall_mood = ?,
-                wake_feeling_notes = ?,
-                mood_notes = ?,
-                general_notes = ?,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE entry_date = ?
-        """, (
-            data.get('bed_time'),
-            data.get('wake_time'),
-            data.get('med_melatonin', 0),
-            data.get('med_weed', 0),
-            data.get('med_cold_medicine', 0),
-            data.get('med_benadryl', 0),
-            data.get('wake_feeling'),
-            data.get('overall_mood'),
-            data.get('wake_feeling_notes'),
-            data.get('mood_notes'),
-            data.get('general_notes'),
-            data['entry_date']
-        ))
-    else:
-        # Insert new entry
-        cursor.execute("""
+    with transaction("sleep_entries") as conn:
+        # Insert a new row, or update the existing one for this date
+        conn.execute("""
             INSERT INTO sleep_entries (
                 entry_date, bed_time, wake_time,
                 med_melatonin, med_weed, med_cold_medicine, med_benadryl,
                 wake_feeling, overall_mood,
                 wake_feeling_notes, mood_notes, general_notes
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            data['entry_date'],
-            data.get('bed_time'),
-            data.get('wake_time'),
-            data.get('med_melatonin', 0),
-            data.get('med_weed', 0),
-            data.get('med_cold_medicine', 0),
-            data.get('med_benadryl', 0),
-            data.get('wake_feeling'),
-            data.get('overall_mood'),
-            data.get('wake_feeling_notes'),
-            data.get('mood_notes'),
-            data.get('general_notes')
-        ))
-    
-    conn.commit()
-    conn.close()
+            ) VALUES (
+                :entry_date, :bed_time, :wake_time,
+                :med_melatonin, :med_weed, :med_cold_medicine, :med_benadryl,
+                :wake_feeling, :overall_mood,
+                :wake_feeling_notes, :mood_notes, :general_notes
+            )
+            ON CONFLICT(entry_date) DO UPDATE SET
+                bed_time = excluded.bed_time,
+                wake_time = excluded.wake_time,
+                med_melatonin = excluded.med_melatonin,
+                med_weed = excluded.med_weed,
+                med_cold_medicine = excluded.med_cold_medicine,
+                med_benadryl = excluded.med_benadryl,
+                wake_feeling = excluded.wake_feeling,
+                overall_mood = excluded.overall_mood,
+                wake_feeling_notes = excluded.wake_feeling_notes,
+                mood_notes = excluded.mood_notes,
+                general_notes = excluded.general_notes,
+                updated_at = CURRENT_TIMESTAMP
+        """, {**SLEEP_ENTRY_DEFAULTS, **data})
 
 
+@cached(ttl=30, tag="sleep_entries")
 def get_sleep_entry(entry_date):
     """Get a single sleep entry by date."""
     conn = get_connection()
@@ -164,37 +403,81 @@ def get_sleep_entry(entry_date):
         "SELECT * FROM sleep_entries WHERE entry_date = ?", 
         (entry_date,)
     )
-    row = cursor.fetchone()
-    conn.close()
-    return dict(row) if row else None
+    rows = _rows_to_dicts(cursor)
+    return rows[0] if rows else None
 
 
+@cached(ttl=30, tag="sleep_entries")
 def get_all_sleep_entries(limit=None):
     """Get all sleep entries, most recent first."""
     conn = get_connection()
     cursor = conn.cursor()
     
-    query = "SELECT * FROM sleep_entries ORDER BY entry_date DESC"
-    if limit:
-        query += f" LIMIT {limit}"
+    # LIMIT is bound as a parameter so every call shares one prepared
+    # statement; SQLite treats a negative limit as "no limit"
+    limit = int(limit) if limit else -1
     
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    cursor.execute(
+        "SELECT * FROM sleep_entries ORDER BY entry_date DESC LIMIT ?",
+        (limit,)
+    )
+    return _rows_to_dicts(cursor)
 
 
-def get_entries_for_month(year, month):
-    """Get all entries for a specific month (for calendar view)."""
+def iter_all_sleep_entries():
+    """
+    Yield every sleep entry, most recent first, one row at a time.
+    Lets the history page stream its table without loading every row first.
+    """
     conn = get_connection()
     cursor = conn.cursor()
     
-    # Format: entries where date is in the given month
+    cursor.execute("SELECT * FROM sleep_entries ORDER BY entry_date DESC")
+    keys = [column[0] for column in cursor.description]
+    for row in cursor:
+        yield dict(zip(keys, row))
+
+
+@cached(ttl=30, tag="sleep_entries")
+def get_history_summary():
+    """Get the summary statistics shown under the history table."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    # NULLIF skips ratings that were left blank (or 0) in the averages
+    cursor.execute("""
+        SELECT COUNT(*) AS total_entries,
+               AVG(NULLIF(NULLIF(overall_mood, ''), 0)) AS avg_mood,
+               AVG(NULLIF(NULLIF(wake_feeling, ''), 0)) AS avg_wake_feeling,
+               COALESCE(SUM(med_melatonin), 0) AS melatonin_count,
+               COALESCE(SUM(med_weed), 0) AS weed_count,
+               COALESCE(SUM(med_cold_medicine), 0) AS cold_medicine_count,
+               COALESCE(SUM(med_benadryl), 0) AS benadryl_count
+        FROM sleep_entries
+    """)
+    
+    return _rows_to_dicts(cursor)[0]
+
+
+@lru_cache(maxsize=512)
+def _month_bounds(year, month):
+    """Return the first day of the month and of the next month as 'YYYY-MM-DD'."""
     start_date = f"{year}-{month:02d}-01"
     if month == 12:
         end_date = f"{year + 1}-01-01"
     else:
         end_date = f"{year}-{month + 1:02d}-01"
+    return start_date, end_date
+
+
+@cached(ttl=30, tag="sleep_entries")
+def get_entries_for_month(year, month):
+    """Get all entries for a specific month (for calendar view)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    # Format: entries where date is in the given month
+    start_date, end_date = _month_bounds(year, month)
     
     cursor.execute("""
         SELECT * FROM sleep_entries 
@@ -202,34 +485,70 @@ def get_entries_for_month(year, month):
         ORDER BY entry_date
     """, (start_date, end_date))
     
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    return _rows_to_dicts(cursor)
 
 
-# ----- Mood Check-in Functions -----
+@cached(ttl=30, tag="sleep_entries")
+def get_home_bundle(today, limit=7):
+    """
+    Get everything the dashboard needs in one call: the most recent
+    entries and today's entry (None if there isn't one yet).
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(
+        "SELECT * FROM sleep_entries ORDER BY entry_date DESC LIMIT ?",
+        (limit,)
+    )
+    recent = _rows_to_dicts(cursor)
+    
+    # Today's entry is usually the newest one, so it's often already loaded
+    today_entry = next((e for e in recent if e['entry_date'] == today), None)
+    if today_entry is None:
+        cursor.execute(
+            "SELECT * FROM sleep_entries WHERE entry_date = ?",
+            (today,)
+        )
+        rows = _rows_to_dicts(cursor)
+        today_entry = rows[0] if rows else None
+    
+    return {'recent': recent, 'today': today_entry}
 
-def save_mood_checkin(data):
-    """Save a mood/energy check-in."""
+
+@cached(ttl=30, tag="sleep_entries")
+def get_chart_sleep_series(limit=30):
+    """
+    Get just the columns the charts use from the most recent entries,
+    most recent first (notes and timestamps are left out).
+    """
     conn = get_connection()
     cursor = conn.cursor()
     
     cursor.execute("""
-        INSERT INTO mood_checkins (
-            entry_date, check_time, mood_level, energy_level, notes
-        ) VALUES (?, ?, ?, ?, ?)
-    """, (
-        data['entry_date'],
-        data['check_time'],
-        data['mood_level'],
-        data['energy_level'],
-        data.get('notes')
-    ))
+        SELECT entry_date, bed_time, wake_time, wake_feeling, overall_mood,
+               med_melatonin, med_weed, med_cold_medicine, med_benadryl
+        FROM sleep_entries
+        ORDER BY entry_date DESC
+        LIMIT ?
+    """, (limit,))
     
-    conn.commit()
-    conn.close()
+    return _rows_to_dicts(cursor)
+
 
+# ----- Mood Check-in Functions -----
+
+def save_mood_checkin(data):
+    """Save a mood/energy check-in."""
+    with transaction("mood_checkins") as conn:
+        conn.execute("""
+            INSERT INTO mood_checkins (
+                entry_date, check_time, mood_level, energy_level, notes
+            ) VALUES (:entry_date, :check_time, :mood_level, :energy_level, :notes)
+        """, {'notes': None, **data})
 
+
+@cached(ttl=30, tag="mood_checkins")
 def get_mood_checkins(entry_date):
     """Get all mood check-ins for a specific date."""
     conn = get_connection()
@@ -241,11 +560,10 @@ def get_mood_checkins(entry_date):
         ORDER BY check_time
     """, (entry_date,))
     
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    return _rows_to_dicts(cursor)
 
 
+@cached(ttl=30, tag="mood_checkins")
 def get_recent_mood_checkins(days=7):
     """Get mood check-ins from the last N days."""
     conn = get_connection()
@@ -257,15 +575,50 @@ def get_recent_mood_checkins(days=7):
         ORDER BY entry_date, check_time
     """, (f'-{days} days',))
     
-    rows = cursor.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    return _rows_to_dicts(cursor)
 
 
 def delete_mood_checkin(checkin_id):
     """Delete a mood check-in by ID."""
+    with transaction("mood_checkins") as conn:
+        conn.execute("DELETE FROM mood_checkins WHERE id = ?", (checkin_id,))
+
+
+@cached(ttl=30, tag="mood_checkins")
+def get_checkin_hourly_averages(days=30):
+    """
+    Average mood and energy for each hour of the day over the last N days.
+    CAST takes the leading hour from check_time ("09:15" -> 9).
+    """
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM mood_checkins WHERE id = ?", (checkin_id,))
-    conn.commit()
-    conn.close()
+    
+    cursor.execute("""
+        SELECT CAST(check_time AS INTEGER) AS hour,
+               AVG(mood_level) AS avg_mood,
+               AVG(energy_level) AS avg_energy,
+               COUNT(*) AS checkin_count
+        FROM mood_checkins
+        WHERE entry_date >= date('now', ?)
+        GROUP BY hour
+        ORDER BY hour
+    """, (f'-{days} days',))
+    
+    return _rows_to_dicts(cursor)
+
+
+# ----- Combined Queries -----
+
+@cached(ttl=30, tag=("sleep_entries", "mood_checkins"))
+def get_charts_bundle(limit=30, days=30):
+    """
+    Get the sleep series and hourly check-in averages for the charts page
+    from a single read transaction, so both come from the same snapshot.
+    Returns (entries, checkin_hours).
+    """
+    with transaction():
+        # Call the underlying queries directly, skipping their own caches
+        entries = get_chart_sleep_series.__wrapped__(limit)
+        checkin_hours = get_checkin_hourly_averages.__wrapped__(days)
+    
+    return entries, checkin_hours